@@ -1,31 +1,86 @@
 from lark import Lark, Transformer, Visitor, Tree, Token, Discard
-from .stackautomaton import NonErasingStackAutomaton, Transition
+from .stackautomaton import NonErasingStackAutomaton, Transition, ANY
+from importlib import resources
+import functools
+import hashlib
 import itertools
+import os
+import sys
 
-with open('nedsascript/nedsascript_grammar.lark', 'r') as grammar:
-    nedsascript_parser = Lark(grammar, start = 'program')
+@functools.lru_cache(maxsize = None)
+def nedsascript_parser():
+    # built the first time something is parsed rather than on import. the grammar is LALR, so lark can cache the
+    # analysed parser on disk and later processes just load it
+    return Lark(resources.files(__package__).joinpath('nedsascript_grammar.lark').read_text(), start = 'program', parser = 'lalr', cache = True)
 
 def parse(code):
-    initial_tree = nedsascript_parser.parse(code)
+    initial_tree = nedsascript_parser().parse(code)
     processed_tree = EndReplacer().transform(initial_tree)
     return processed_tree
 
-def construct_nedsa(code):
+def construct_nedsa(code, lazy = True, cache_dir = None):
+    # with a cache_dir, the compiled automaton is saved there under a hash of the code and the compiler,
+    # so running an unchanged program again skips parsing and expansion entirely
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, hashlib.sha256(compiler_version() + code.encode('utf-8')).hexdigest() + '.nedsa')
+        try:
+            return Script(NonErasingStackAutomaton.load(cache_path))
+        except (OSError, ValueError):
+            pass # not cached yet, or not something we can read
+    script = Script(build_nedsa(code, lazy))
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+        # written under a temporary name first so that nobody loads a half-written file
+        script.nedsa.save(f"{cache_path}.{os.getpid()}.tmp")
+        os.replace(f"{cache_path}.{os.getpid()}.tmp", cache_path)
+    return script
+
+@functools.lru_cache(maxsize = None)
+def compiler_version():
+    # changes whenever the compiler does, so automata cached by a different version are never loaded
+    version = hashlib.sha256(sys.byteorder.encode('utf-8'))
+    for filename in ['script.py', 'stackautomaton.py', 'nedsascript_grammar.lark']:
+        version.update(resources.files(__package__).joinpath(filename).read_bytes())
+    return version.digest()
+
+def build_nedsa(code, lazy = True):
+    # lazy construction only generates the states reachable from the initial variable values, instead of every
+    # combination of variable values for every statement
     new_tree, variables, states, alphabet = Preprocessor().transform(parse(code))
+    if lazy:
+        return explore_program(new_tree, alphabet, list(variables.keys()), [v[0] for v in variables.values()], [v[1] for v in variables.values()])
     variable_possibilities = list(map(list, itertools.product(*[list(range(v[1]+1)) for v in variables.values()])))
     variable_names = list(variables.keys()) # tells us what order variable_possibilities is in
     variable_initialisations = [v[0] for v in variables.values()]
     variable_maximums = [v[1] for v in variables.values()]
-    return Script(parse_program(new_tree, alphabet, variable_possibilities, variable_names, variable_initialisations, variable_maximums))
+    return parse_program(new_tree, alphabet, variable_possibilities, variable_names, variable_initialisations, variable_maximums)
 
 class Script:
     def __init__(self, nedsa):
         self.nedsa = nedsa
-    def run(self):
-        return self.clean(self.nedsa.run('+START+'))
-    def decide(self, verbose = False):
+        self._minimized = None
+    def run(self, verbose = False, fast = True, max_steps = None):
+        # fast runs resolve trips down the stack with transition tables rather than step by step.
+        # either way a run that takes more than max_steps steps is stopped with '+BUDGETEXCEEDED+'
+        if fast:
+            return self.clean(self.nedsa.run_with_summaries('+START+', verbose, max_steps))
+        return self.clean(self.nedsa.run('+START+', verbose, max_steps))
+    def decide(self, verbose = False, minimize = True):
         # same as run, but instead of running forever it'll return '+DOESNOTHALT+'
-        return self.clean(self.nedsa.run_with_transition_tables('+START+', verbose))
+        nedsa = self.minimized if minimize else self.nedsa
+        if verbose and minimize:
+            print(f"minimized from {self.state_counts[0]} to {self.state_counts[1]} states")
+        return self.clean(nedsa.run_with_transition_tables('+START+', verbose))
+    @property
+    def minimized(self):
+        # only the cleaned names of halting states are visible from outside, so states halting with the same label can merge
+        if self._minimized is None:
+            self._minimized = self.nedsa.minimized(output = self.clean)
+        return self._minimized
+    @property
+    def state_counts(self):
+        # number of states before and after minimization
+        return (len(self.nedsa.states), len(self.minimized.states))
     def clean(self, string):
         # '-' is a character that can't appear in user-specified labels that's used to seperate out variable data
         return string.partition('-')[0]
@@ -49,12 +104,10 @@ def remove_duplicates(lst):
 
 class EndReplacer(Transformer):
     # replace any initial codeblock with a labelledcodeblock with the label +FIRSTLABEL (note the + makes it not a valid user-declared label)
-    # and replace any final label with a labelledcodeblock with an empty codeblock
+    # (a final label on its own already parses as a labelledcodeblock with no statements)
     def program(self, items):
         if isinstance(items[0], Tree) and items[0].data == 'codeblock':
             items[0] = Tree(Token('RULE', 'labelledcodeblock'), [Tree(Token('RULE', 'label'), [Token('NAME', '+FIRSTLABEL')])] + items[0].children)
-        if isinstance(items[-1], Tree) and items[-1].data == 'label':
-            items[-1] = Tree(Token('RULE', 'labelledcodeblock'), [items[-1]])
         return Tree(Token('RULE', 'program'), items)
 
 class Preprocessor(Transformer):
@@ -76,8 +129,8 @@ class Preprocessor(Transformer):
         return Tree(Token('RULE', 'labelledcodeblock'), items)
     def vardeclaration(self, items):
         name = items[0].value
-        value = items[1]
-        maximum = items[2]
+        value = int(items[1].value)
+        maximum = int(items[2].value)
         if name in self.vars:
             raise(ParseException(f"parse error: variable '{name}' declared twice"))
         elif value > maximum:
@@ -106,9 +159,8 @@ def parse_program(program, alphabet, variable_possibilities, variable_names, var
         transitions += new_transitions
         if i + 1 < len(program.children):
             for ending in state_endings(vps):
-                for symbol in alphabet:
-                    transitions.append(Transition(program.children[i].children[0].children[0].value + ending + '-block' + str(final_n), symbol,
-                                                  program.children[i+1].children[0].children[0].value + ending, {}))
+                transitions.append(Transition(program.children[i].children[0].children[0].value + ending + '-block' + str(final_n), ANY,
+                                              program.children[i+1].children[0].children[0].value + ending, {}))
     return NonErasingStackAutomaton(transitions)
 
 
@@ -116,8 +168,7 @@ def parse_labelled_block(block, alphabet, variable_possibilities, variable_names
     transitions = []
     label = block.children[0].children[0].value
     for ending in state_endings(variable_possibilities):
-        for symbol in alphabet:
-            transitions.append(Transition(label + ending, symbol, label + ending + '-block0', {}))
+        transitions.append(Transition(label + ending, ANY, label + ending + '-block0', {}))
     new_transitions, new_variable_possibilities, new_n = parse_codeblock(block.children[1:], label, alphabet, variable_possibilities, variable_names, variable_maximums, 0)
     transitions += new_transitions
     return transitions, new_variable_possibilities, new_n
@@ -129,26 +180,22 @@ def parse_codeblock(block, label, alphabet, variable_possibilities, var_names, v
             pass
         elif statement.data == 'push':
             for ending in state_endings(variable_possibilities):
-                for symbol in alphabet:
-                    transitions.append(Transition(label + ending + '-block' + str(n), symbol, label + ending + '-block' + str(n+1), {'push': statement.children[0].value}))
+                transitions.append(Transition(label + ending + '-block' + str(n), ANY, label + ending + '-block' + str(n+1), {'push': statement.children[0].value}))
             n += 1
         elif statement.data == 'move':
             for ending in state_endings(variable_possibilities):
-                for symbol in alphabet:
-                    transitions.append(Transition(label + ending + '-block' + str(n), symbol, label + ending + '-block' + str(n+1),
-                                               {'move': {'DOWN':'left', 'UP':'right'}[statement.children[0].value]}))
+                transitions.append(Transition(label + ending + '-block' + str(n), ANY, label + ending + '-block' + str(n+1),
+                                              {'move': {'DOWN':'left', 'UP':'right'}[statement.children[0].value]}))
             n += 1
         elif statement.data == 'halt':
             for ending in state_endings(variable_possibilities):
-                for symbol in alphabet:
-                    transitions.append(Transition(label + ending + '-block' + str(n), symbol, statement.children[0].value + ending + '-halt', {}))
+                transitions.append(Transition(label + ending + '-block' + str(n), ANY, statement.children[0].value + ending + '-halt', {}))
             n += 1 # in case a halt is the last statement in an if block, so that new_n will be different from n
             # in all other cases doesn't matter, since no transition leads to -block(n) or -block(n+1) after a halt
             # same is true of goto below
         elif statement.data == 'goto':
             for ending in state_endings(variable_possibilities):
-                for symbol in alphabet:
-                    transitions.append(Transition(label + ending + '-block' + str(n), symbol, statement.children[0].value + ending, {}))
+                transitions.append(Transition(label + ending + '-block' + str(n), ANY, statement.children[0].value + ending, {}))
             n += 1
         elif statement.data == 'varassignment':
             var = statement.children[0].value
@@ -164,12 +211,10 @@ def parse_codeblock(block, label, alphabet, variable_possibilities, var_names, v
                 new_possibility = list(variable_possibilities[i])
                 new_possibility[var_index] = new_val
                 if new_val > var_maxs[var_index] or new_val < 0:
-                    for symbol in alphabet:
-                        transitions.append(Transition(label + state_ending(variable_possibilities[i]) + '-block' + str(n), symbol, label + '-halt-variableoutsidebounds', {}))
+                    transitions.append(Transition(label + state_ending(variable_possibilities[i]) + '-block' + str(n), ANY, label + '-halt-variableoutsidebounds', {}))
                     to_remove.append(i) # mark for removal, but we're iterating over the list right now
                 else:
-                    for symbol in alphabet:
-                        transitions.append(Transition(label + state_ending(variable_possibilities[i]) + '-block' + str(n), symbol, label + state_ending(new_possibility) + '-block' + str(n+1), {}))
+                    transitions.append(Transition(label + state_ending(variable_possibilities[i]) + '-block' + str(n), ANY, label + state_ending(new_possibility) + '-block' + str(n+1), {}))
                     variable_possibilities[i] = new_possibility
             for i in to_remove:
                 variable_possibilities[i] = None
@@ -180,39 +225,132 @@ def parse_codeblock(block, label, alphabet, variable_possibilities, var_names, v
             for ending in state_endings(variable_possibilities):
                 transitions.append(Transition(label + ending + '-block' + str(n), read_symbol, label + ending + '-block' + str(n+1), {}))
             new_transitions, new_variable_possibilities, new_n = parse_codeblock(statement.children[1].children, label, alphabet, list(variable_possibilities), var_names, var_maxs, n + 1)
-            for ending in state_endings(variable_possibilities):
-                for symbol in alphabet:
-                    if symbol != read_symbol:
-                        transitions.append(Transition(label + ending + '-block' + str(n), symbol, label + ending + '-block' + str(new_n), {}))
+            if len(alphabet) > 1: # otherwise there's nothing else that could be read
+                for ending in state_endings(variable_possibilities):
+                    # the transition on read_symbol takes priority over this one
+                    transitions.append(Transition(label + ending + '-block' + str(n), ANY, label + ending + '-block' + str(new_n), {}))
             transitions += new_transitions
             variable_possibilities += [possibility for possibility in new_variable_possibilities if possibility not in variable_possibilities]
             n = new_n
         elif statement.data == 'ifcomparison':
             constrained_possibilities = constrain_possibilities(list(variable_possibilities), var_names, statement.children[0], statement.children[1], statement.children[2])
             for ending in state_endings(constrained_possibilities):
-                for symbol in alphabet:
-                    transitions.append(Transition(label + ending + '-block' + str(n), symbol, label + ending + '-block' + str(n+1), {}))
+                transitions.append(Transition(label + ending + '-block' + str(n), ANY, label + ending + '-block' + str(n+1), {}))
             new_transitions, new_variable_possibilities, new_n = parse_codeblock(statement.children[3].children, label, alphabet, list(constrained_possibilities), var_names, var_maxs, n + 1)
             transitions += new_transitions
             for ending in state_endings([possibility for possibility in variable_possibilities if possibility not in constrained_possibilities]):
-                for symbol in alphabet:
-                    transitions.append(Transition(label + ending + '-block' + str(n), symbol, label + ending + '-block' + str(new_n), {}))
+                transitions.append(Transition(label + ending + '-block' + str(n), ANY, label + ending + '-block' + str(new_n), {}))
             variable_possibilities += [possibility for possibility in new_variable_possibilities if possibility not in variable_possibilities]
             n = new_n
     return transitions, variable_possibilities, n
 
+def explore_program(program, alphabet, var_names, var_inits, var_maxs):
+    # builds the same transitions as parse_program, but working forwards from the initial variable values so that only
+    # reachable (label, variable values, block index) states are ever generated
+    labels = [block.children[0].children[0].value for block in program.children]
+    instructions = {}
+    for i in range(len(program.children)):
+        instructions[labels[i]] = {}
+        final_n = flatten_codeblock(program.children[i].children[1:], var_names, instructions[labels[i]], 0)
+        if i + 1 < len(labels):
+            instructions[labels[i]][final_n] = ('goto', labels[i+1], None)
+    transitions = [Transition('+START+', 'BLANK', labels[0] + state_ending(var_inits), {})]
+    seen = set()
+    to_visit = []
+    def visit(label, possibility, n):
+        if (label, possibility, n) not in seen:
+            seen.add((label, possibility, n))
+            to_visit.append((label, possibility, n))
+    def add_transition(state, state_to, side_effects = {}, symbol = ANY):
+        transitions.append(Transition(state, symbol, state_to, side_effects))
+    visit(labels[0], tuple(var_inits), None)
+    while len(to_visit) > 0:
+        label, possibility, n = to_visit.pop()
+        ending = state_ending(possibility)
+        if n is None:
+            # entering a label. labels that don't exist have no transitions, so halt there
+            if label in instructions:
+                add_transition(label + ending, label + ending + '-block0')
+                visit(label, possibility, 0)
+            continue
+        if n not in instructions[label]:
+            # the end of the last labelled block halts
+            continue
+        state = label + ending + '-block' + str(n)
+        instruction = instructions[label][n]
+        if instruction[0] == 'push':
+            add_transition(state, label + ending + '-block' + str(instruction[2]), {'push': instruction[1]})
+            visit(label, possibility, instruction[2])
+        elif instruction[0] == 'move':
+            add_transition(state, label + ending + '-block' + str(instruction[2]), {'move': {'DOWN':'left', 'UP':'right'}[instruction[1]]})
+            visit(label, possibility, instruction[2])
+        elif instruction[0] == 'halt':
+            add_transition(state, instruction[1] + ending + '-halt')
+        elif instruction[0] == 'goto':
+            add_transition(state, instruction[1] + ending)
+            visit(instruction[1], possibility, None)
+        elif instruction[0] == 'varassignment':
+            new_val = instruction[2](possibility)
+            if new_val > var_maxs[instruction[1]] or new_val < 0:
+                add_transition(state, label + '-halt-variableoutsidebounds')
+            else:
+                new_possibility = possibility[:instruction[1]] + (new_val,) + possibility[instruction[1]+1:]
+                add_transition(state, label + state_ending(new_possibility) + '-block' + str(instruction[3]))
+                visit(label, new_possibility, instruction[3])
+        elif instruction[0] == 'ifread':
+            add_transition(state, label + ending + '-block' + str(instruction[2]), symbol = instruction[1])
+            visit(label, possibility, instruction[2])
+            if len(alphabet) > 1: # otherwise there's nothing else that could be read
+                add_transition(state, label + ending + '-block' + str(instruction[3]))
+                visit(label, possibility, instruction[3])
+        elif instruction[0] == 'ifcomparison':
+            next_n = instruction[2] if instruction[1](possibility) else instruction[3]
+            add_transition(state, label + ending + '-block' + str(next_n))
+            visit(label, possibility, next_n)
+    return NonErasingStackAutomaton(transitions)
+
+def flatten_codeblock(block, var_names, instructions, n):
+    # lays out the statements of a block the same way parse_codeblock numbers its -blockN states, filling in
+    # instructions with n -> (statement type, arguments..., the block index(es) it continues to)
+    for statement in block:
+        if statement.data == 'pass':
+            pass
+        elif statement.data in ['push', 'move', 'halt', 'goto']:
+            instructions[n] = (statement.data, statement.children[0].value, n + 1)
+            n += 1
+        elif statement.data == 'varassignment':
+            var = statement.children[0].value
+            if var not in var_names:
+                raise(ParseException(f"assignment to nonexistant variable {var}"))
+            instructions[n] = ('varassignment', var_names.index(var), ExpressionEvaluator(var_names).transform(statement.children[1]), n + 1)
+            n += 1
+        elif statement.data == 'ifread':
+            new_n = flatten_codeblock(statement.children[1].children, var_names, instructions, n + 1)
+            instructions[n] = ('ifread', statement.children[0].value, n + 1, new_n)
+            n = new_n
+        elif statement.data == 'ifcomparison':
+            new_n = flatten_codeblock(statement.children[3].children, var_names, instructions, n + 1)
+            instructions[n] = ('ifcomparison', make_comparison(var_names, statement.children[0], statement.children[1], statement.children[2]), n + 1, new_n)
+            n = new_n
+    return n
+
 
 def constrain_possibilities(var_possibilities, var_names, a, comparator, b):
-    evaluator = ExpressionEvaluator(var_names)
-    fa = evaluator.transform(a)
-    fb = evaluator.transform(b)
-    comp = {'=': lambda a,b: a == b, '>': lambda a,b: a > b, '<': lambda a,b: a < b, '>=': lambda a,b: a >= b, '<=': lambda a,b: a <= b, '!=': lambda a,b: a != b}[comparator]
+    comparison = make_comparison(var_names, a, comparator, b)
     r = []
     for possibility in var_possibilities:
-        if comp(fa(possibility), fb(possibility)):
+        if comparison(possibility):
             r.append(possibility)
     return r
 
+def make_comparison(var_names, a, comparator, b):
+    # constructs a function that takes a list of variable values and says whether the comparison holds
+    evaluator = ExpressionEvaluator(var_names)
+    fa = evaluator.transform(a)
+    fb = evaluator.transform(b)
+    comp = {'=': lambda a,b: a == b, '>': lambda a,b: a > b, '<': lambda a,b: a < b, '>=': lambda a,b: a >= b, '<=': lambda a,b: a <= b, '!=': lambda a,b: a != b}[comparator]
+    return lambda possibility: comp(fa(possibility), fb(possibility))
+
 
 class ExpressionEvaluator(Transformer):
     # constructs a function that takes a list of variable values and produces an expression value
@@ -225,8 +363,13 @@ class ExpressionEvaluator(Transformer):
         elif len(items) == 3: # operation
             operation = {'+': lambda a,b: a+b, '-': lambda a,b: a-b, '*': lambda a,b: a*b, '/': lambda a,b: a//b, '%': lambda a,b: a%b}[items[1].value]
             return lambda variables: operation(items[0](variables), items[2](variables))
+        elif callable(items[0]): # a single level of precedence, or brackets, around an expression that's already been evaluated
+            return items[0]
         else: # in all other cases it's already been processed into a list of numbers
             return lambda variables: items[0]
+    # every level of precedence is evaluated the same way
+    term = expression
+    factor = expression
     
 
 class ParseException(Exception):
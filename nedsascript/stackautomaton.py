@@ -1,3 +1,12 @@
+from array import array
+from collections import OrderedDict
+import json
+import mmap
+import struct
+
+
+# value_from for a default transition, taken on any symbol that the state has no transition of its own for
+ANY = '+ANY+'
 
 class Transition:
     def __init__(self, state_from, value_from, state_to, side_effects):
@@ -7,24 +16,47 @@ class Transition:
         self.push = side_effects['push'] if 'push' in side_effects else None
         self.move = {'left': -1, 'right': 1}[side_effects['move']] if 'move' in side_effects else 0
 
-class TableTransition:
-    # elements of the transition table can't push or move, but they do need to be able to halt before reaching the end
-    def __init__(self, state_from, state_to, halt = False):
-        self.state_from = state_from
-        self.state_to = state_to
-        self.halt = halt
-    def __eq__(self, other):
-        # required so that transition tables can be compared for equality
-        if isinstance(other, TableTransition):
-            return self.state_from == other.state_from and self.state_to == other.state_to and self.halt == other.halt
-        else:
-            return False
-        
+# results that aren't reached by any transition get reserved ids at the start of the state numbering,
+# so transition tables can point at them the same way they point at ordinary halting states
+RESULT_STATES = ('+REJECT:INVALIDMOVE+', '+REJECT:INVALIDPUSH+', '+DOESNOTHALT+')
+INVALIDMOVE, INVALIDPUSH, DOESNOTHALT = range(len(RESULT_STATES))
+NO_TRANSITION = -1
+# returned instead of a state when a run is stopped before it finishes
+BUDGET_EXCEEDED = '+BUDGETEXCEEDED+'
+
+# layout of a saved automaton: the header, the names as json padded to a multiple of 4 bytes,
+# then the targets, pushes and moves arrays exactly as they are in memory, so they can be mapped straight from the file
+SAVE_MAGIC = b'NEDSAAUT'
+SAVE_FORMAT = 1
+SAVE_HEADER = struct.Struct('<8sIIII')
+
+class CompositionCache:
+    # the table for a stack only depends on the table of the stack below and the symbol pushed on top, and programs
+    # tend to push the same symbols onto the same stacks over and over, so remember (table id, symbol) -> table id.
+    # bounded, evicting the least recently used entry
+    def __init__(self, maxsize = 65536):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def get(self, table_id, symbol):
+        if (table_id, symbol) in self.entries:
+            self.entries.move_to_end((table_id, symbol))
+            self.hits += 1
+            return self.entries[(table_id, symbol)]
+        self.misses += 1
+        return None
+    def put(self, table_id, symbol, new_table_id):
+        self.entries[(table_id, symbol)] = new_table_id
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+    def __len__(self):
+        return len(self.entries)
 
 class NonErasingStackAutomaton:
     # inputless version, because that's all i need
     def __init__(self, transitions):
-        self.transitions = {}
+        self._transitions = {}
         for transition in transitions:
             if (transition.state_from, transition.value_from) in self.transitions:
                 raise(Exception(f"duplicate transition detected from {(transition.state_from, transition.value_from)} to both {transition.state_to} and {self.transitions[(transition.state_from, transition.value_from)].state_to}"))
@@ -34,74 +66,295 @@ class NonErasingStackAutomaton:
         for transition in transitions:
             self.states.add(transition.state_from)
             self.states.add(transition.state_to)
-            self.alphabet.add(transition.value_from)
+            if transition.value_from != ANY:
+                self.alphabet.add(transition.value_from)
+            if transition.push is not None:
+                self.alphabet.add(transition.push)
         self.prune_states()
+        self.compile()
+    @classmethod
+    def from_compiled(cls, state_names, state_ids, symbol_names, targets, pushes, moves):
+        # make an automaton straight from the arrays compile() would produce. state_ids may map several names to the same
+        # id, so that states merged away still work as starting points
+        nedsa = cls.__new__(cls)
+        nedsa.state_names = state_names
+        nedsa.state_ids = state_ids
+        nedsa.symbol_names = symbol_names
+        nedsa.symbol_ids = {name: i for i, name in enumerate(symbol_names)}
+        nedsa.targets = targets
+        nedsa.pushes = pushes
+        nedsa.moves = moves
+        nedsa.states = set(state_names[len(RESULT_STATES):])
+        nedsa.alphabet = set(symbol_names)
+        nedsa._transitions = None
+        nedsa.reset_tables()
+        return nedsa
+    def save(self, path):
+        names = json.dumps({'states': self.state_names, 'symbols': self.symbol_names,
+                            'aliases': {name: i for name, i in self.state_ids.items() if self.state_names[i] != name}}).encode('utf-8')
+        names += b' ' * (-len(names) % 4)
+        with open(path, 'wb') as file:
+            file.write(SAVE_HEADER.pack(SAVE_MAGIC, SAVE_FORMAT, len(self.state_names), len(self.symbol_names), len(names)))
+            file.write(names)
+            file.write(self.targets)
+            file.write(self.pushes)
+            file.write(self.moves)
+    @classmethod
+    def load(cls, path):
+        # the arrays stay memory-mapped, so loading doesn't depend on the size of the automaton beyond reading the names
+        with open(path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        if len(data) < SAVE_HEADER.size:
+            raise(ValueError(f"{path} is too short to be a saved automaton"))
+        magic, save_format, n_states, n_symbols, names_length = SAVE_HEADER.unpack_from(data)
+        if magic != SAVE_MAGIC or save_format != SAVE_FORMAT:
+            raise(ValueError(f"{path} isn't a saved automaton in format {SAVE_FORMAT}"))
+        size = n_states * n_symbols
+        if len(data) != SAVE_HEADER.size + names_length + size * 9:
+            raise(ValueError(f"{path} has the wrong length for a saved automaton of its size"))
+        names = json.loads(bytes(data[SAVE_HEADER.size:SAVE_HEADER.size + names_length]).decode('utf-8'))
+        arrays = memoryview(data)[SAVE_HEADER.size + names_length:]
+        state_ids = {name: i for i, name in enumerate(names['states'])}
+        state_ids.update(names['aliases'])
+        return cls.from_compiled(names['states'], state_ids, names['symbols'],
+                                 arrays[:size * 4].cast('i'), arrays[size * 4:size * 8].cast('i'), arrays[size * 8:].cast('b'))
+    @property
+    def transitions(self):
+        # automata made from_compiled only work out their Transition objects if someone asks for them
+        if self._transitions is None:
+            self._transitions = {}
+            width = len(self.symbol_names)
+            for state in range(len(RESULT_STATES), len(self.state_names)):
+                row = range(state * width, (state + 1) * width)
+                entries = set((self.targets[i], self.pushes[i], self.moves[i]) for i in row)
+                for i in row:
+                    if self.targets[i] != NO_TRANSITION:
+                        symbol = ANY if len(entries) == 1 else self.symbol_names[i - state * width]
+                        side_effects = {}
+                        if self.pushes[i] != NO_TRANSITION:
+                            side_effects['push'] = self.symbol_names[self.pushes[i]]
+                        if self.moves[i] != 0:
+                            side_effects['move'] = {-1: 'left', 1: 'right'}[self.moves[i]]
+                        self._transitions[(self.state_names[state], symbol)] = Transition(self.state_names[state], symbol, self.state_names[self.targets[i]], side_effects)
+                        if symbol == ANY:
+                            break
+        return self._transitions
     def prune_states(self):
         # remove all unreachable states and transitions, so the transition tables won't be so large
-        reachable = []
-        def mark_reachable(state):
-            reachable.append(state)
-            for symbol in self.alphabet:
-                if (state, symbol) in self.transitions and self.transitions[(state,symbol)].state_to not in reachable:
-                    mark_reachable(self.transitions[(state,symbol)].state_to)
-        mark_reachable('+START+')
-        unreachable = [state for state in self.states if state not in reachable]
-        for state in unreachable:
-            self.states.remove(state)
-            for symbol in self.alphabet:
-                if (state, symbol) in self.transitions:
-                    self.transitions.pop((state,symbol))
+        following = {}
+        for (state, symbol), t in self.transitions.items():
+            following.setdefault(state, []).append(t.state_to)
+        reachable = set(['+START+'])
+        to_visit = ['+START+']
+        while len(to_visit) > 0:
+            for state_to in following.get(to_visit.pop(), []):
+                if state_to not in reachable:
+                    reachable.add(state_to)
+                    to_visit.append(state_to)
+        self.states &= reachable
+        for (state, symbol) in [key for key in self.transitions if key[0] not in reachable]:
+            self.transitions.pop((state, symbol))
+    def compile(self):
+        # intern states and stack symbols to dense integer ids and store the transitions in flat arrays indexed by
+        # state * len(symbol_names) + symbol, so running and deciding don't have to hash tuples of strings every step.
+        # the names are only kept for reporting results
+        self.state_names = list(RESULT_STATES) + sorted(self.states - set(RESULT_STATES))
+        self.state_ids = {name: i for i, name in enumerate(self.state_names)}
+        self.symbol_names = ['BLANK'] + sorted(self.alphabet - set(['BLANK']))
+        self.symbol_ids = {name: i for i, name in enumerate(self.symbol_names)}
+        size = len(self.state_names) * len(self.symbol_names)
+        self.targets = array('i', [NO_TRANSITION]) * size
+        self.pushes = array('i', [NO_TRANSITION]) * size
+        self.moves = array('b', [0]) * size
+        # default transitions fill in the whole row for their state first, then any transitions on specific symbols override them
+        for (state, symbol), t in sorted(self.transitions.items(), key = lambda item: item[0][1] != ANY):
+            if symbol == ANY:
+                start, stop = self.state_ids[state] * len(self.symbol_names), (self.state_ids[state] + 1) * len(self.symbol_names)
+            else:
+                start = self.state_ids[state] * len(self.symbol_names) + self.symbol_ids[symbol]
+                stop = start + 1
+            self.targets[start:stop] = array('i', [self.state_ids[t.state_to]]) * (stop - start)
+            self.pushes[start:stop] = array('i', [NO_TRANSITION if t.push is None else self.symbol_ids[t.push]]) * (stop - start)
+            self.moves[start:stop] = array('b', [t.move]) * (stop - start)
+        self.reset_tables()
+    def reset_tables(self):
+        # every distinct table is interned to an id. these outlive a single decide, so repeated decides on the same
+        # automaton can reuse both the tables and the composition cache
+        self.transition_tables = [self.first_transition_table]
+        self.table_ids = {self.transition_tables[0]: 0}
+        self.composition_cache = CompositionCache()
+    def minimized(self, output = lambda state: state):
+        # an equivalent automaton with fewer states, since the decider is exponential in the number of states.
+        # first states that forward control to the same state whatever they read are skipped over, then states that behave
+        # the same - same pushes and moves, going to equivalent states, halting with the same output - are merged by
+        # partition refinement. output gives the part of a halting state's name that matters
+        width = len(self.symbol_names)
+        forwards_to = list(range(len(self.state_names)))
+        for state in range(len(RESULT_STATES), len(self.state_names)):
+            row = slice(state * width, (state + 1) * width)
+            if self.targets[state * width] != NO_TRANSITION and len(set(self.targets[row])) == 1 \
+               and set(self.pushes[row]) == set([NO_TRANSITION]) and set(self.moves[row]) == set([0]):
+                forwards_to[state] = self.targets[state * width]
+        skip_to = [None] * len(self.state_names)
+        for state in range(len(self.state_names)):
+            chain = []
+            while skip_to[state] is None and forwards_to[state] != state and state not in chain:
+                chain.append(state)
+                state = forwards_to[state]
+            if skip_to[state] is None:
+                # doesn't forward, or closes a loop of forwarding states, so it has to stay
+                skip_to[state] = state
+            for chain_state in chain:
+                if skip_to[chain_state] is None:
+                    skip_to[chain_state] = skip_to[state]
+        kept = [state for state in range(len(self.state_names)) if skip_to[state] == state]
+
+        def row_targets(state, block_of):
+            return tuple(NO_TRANSITION if self.targets[i] == NO_TRANSITION else block_of[skip_to[self.targets[i]]] for i in range(state * width, (state + 1) * width))
+        block_of = {}
+        blocks = {}
+        for state in kept:
+            # the result states are referred to by their ids, so they always get blocks of their own
+            behaviour = state if state < len(RESULT_STATES) else tuple(output(self.state_names[state]) if self.targets[i] == NO_TRANSITION else (self.pushes[i], self.moves[i])
+                                                                      for i in range(state * width, (state + 1) * width))
+            block_of[state] = blocks.setdefault(behaviour, len(blocks))
+        while True:
+            # split blocks whose states go to different blocks, until nothing changes
+            n_blocks = len(blocks)
+            blocks = {}
+            block_of = {state: blocks.setdefault((block_of[state], row_targets(state, block_of)), len(blocks)) for state in kept}
+            if len(blocks) == n_blocks:
+                break
+
+        # each block is represented by its first state, which keeps the result states at the start of the numbering
+        representatives = {}
+        for state in kept:
+            representatives.setdefault(block_of[state], state)
+        new_ids = {block_of[state]: i for i, state in enumerate(sorted(representatives.values()))}
+        targets = array('i')
+        pushes = array('i')
+        moves = array('b')
+        for state in sorted(representatives.values()):
+            targets.extend(target if target == NO_TRANSITION else new_ids[target] for target in row_targets(state, block_of))
+            pushes.extend(self.pushes[state * width:(state + 1) * width])
+            moves.extend(self.moves[state * width:(state + 1) * width])
+        return NonErasingStackAutomaton.from_compiled([self.state_names[state] for state in sorted(representatives.values())],
+                                                      {name: new_ids[block_of[skip_to[state]]] for name, state in self.state_ids.items()},
+                                                      list(self.symbol_names), targets, pushes, moves)
     def print_transitions(self):
         # debugging purposes
         for t in self.transitions.values():
             print(f"{t.value_from}: {t.state_from} -> {t.state_to} ({t.push}, {t.move})")
-    def run(self, state):
+    def run(self, state, verbose = False, max_steps = None):
+        width = len(self.symbol_names)
+        state = self.state_ids[state]
         pointer = 0
         stack = []
+        steps = 0
         while True:
-            print(f"{stack}:{pointer} in {state}")
-            if (state, stack[pointer] if pointer < len(stack) else 'BLANK') in self.transitions:
-                t = self.transitions[(state, stack[pointer] if pointer < len(stack) else 'BLANK')]
-            else:
+            if verbose:
+                print(f"{[self.symbol_names[symbol] for symbol in stack]}:{pointer} in {self.state_names[state]}")
+            if max_steps is not None and steps >= max_steps:
+                return BUDGET_EXCEEDED
+            steps += 1
+            i = state * width + (stack[pointer] if pointer < len(stack) else 0)
+            if self.targets[i] == NO_TRANSITION:
                 # if there's no transition for this situation, halt and return the current state
-                return state
-            state = t.state_to
-            if t.push is not None:
+                return self.state_names[state]
+            state = self.targets[i]
+            if self.pushes[i] != NO_TRANSITION:
                 if pointer == len(stack):
-                    stack += [t.push]
+                    stack.append(self.pushes[i])
                     pointer += 1
                 else:
                     # pushing while not at the top of the stack is rejecting
-                    return '+REJECT:INVALIDPUSH+'
-            pointer += t.move
+                    return self.state_names[INVALIDPUSH]
+            pointer += self.moves[i]
             if pointer < 0 or pointer > len(stack):
                 # moving the pointer off the stack is rejecting
-                return '+REJECT:INVALIDMOVE+'
+                return self.state_names[INVALIDMOVE]
+    def run_with_summaries(self, state, verbose = False, max_steps = None):
+        # same result as run, but keeps the transition table for each level of the stack alongside it, so a MOVE DOWN from
+        # the top is resolved by a single lookup in the top table instead of walking down the stack and back up again.
+        # the pointer is always at the top, so every step reads BLANK, and a step that goes down and comes back counts as one.
+        # excursions below the top that loop forever come back as '+DOESNOTHALT+' instead of running forever
+        width = len(self.symbol_names)
+        state = self.state_ids[state]
+        stack = []
+        table_ids = [0]
+        steps = 0
+        while True:
+            if verbose:
+                print(f"{[self.symbol_names[symbol] for symbol in stack]} in {self.state_names[state]}")
+            if max_steps is not None and steps >= max_steps:
+                return BUDGET_EXCEEDED
+            steps += 1
+            i = state * width # reading BLANK, which is symbol 0
+            if self.targets[i] == NO_TRANSITION:
+                # if there's no transition for this situation, halt and return the current state
+                return self.state_names[state]
+            state = self.targets[i]
+            if self.pushes[i] != NO_TRANSITION:
+                stack.append(self.pushes[i])
+                table_ids.append(self.push_transition_table(table_ids[-1], self.pushes[i]))
+            if self.moves[i] == 1:
+                return self.state_names[INVALIDMOVE]
+            if self.moves[i] == -1:
+                if self.transition_tables[table_ids[-1]][state] & 1:
+                    return self.state_names[self.transition_tables[table_ids[-1]][state] >> 1]
+                else:
+                    state = self.transition_tables[table_ids[-1]][state] >> 1
+    # transition tables are tuples indexed by state id, with each entry encoded as target * 2 + halt, so they're hashable:
+    # elements of the transition table can't push or move, but they do need to be able to halt before reaching the end
     def make_transition_table(self, prev_transition_table, new_value):
-        return {state: self.get_eventual_transition(state, prev_transition_table, new_value) for state in self.states}
-    def get_eventual_transition(self, state, prev_transition_table, new_value):
-        original_state = state
-        for i in range(len(self.states) + 1):
-            if (state, new_value) in self.transitions:
-                t = self.transitions[(state, new_value)]
-            else:
+        # computes the whole new table at once. first work out where a single step of reading new_value takes every state -
+        # either straight to an entry of the table, or on to another state to carry on from - then resolve all the chains of
+        # carrying on in one pass, so every state is only stepped once. a chain that comes back round on itself never halts
+        width = len(self.symbol_names)
+        targets = self.targets[new_value::width]
+        pushes = self.pushes[new_value::width]
+        moves = self.moves[new_value::width]
+        table = [None] * len(self.state_names)
+        carry_on = [NO_TRANSITION] * len(self.state_names)
+        for state in range(len(self.state_names)):
+            if targets[state] == NO_TRANSITION:
                 # if there's no transition for this situation, halts and returns the reached state
-                return TableTransition(original_state, state, halt = True)
-            state = t.state_to
-            if t.push is not None:
+                table[state] = state * 2 + 1
+            elif pushes[state] != NO_TRANSITION:
                 # pushing while not at the top of the stack is rejecting
-                return TableTransition(original_state, '+REJECT:INVALIDPUSH+', halt = True)
-            if t.move == 1:
-                return TableTransition(original_state, state)
-            if t.move == -1:
-                if prev_transition_table[state].halt:
-                    return TableTransition(original_state, prev_transition_table[state].state_to, halt = True)
-                else:
-                    state = prev_transition_table[state].state_to
-        return TableTransition(original_state, '+DOESNOTHALT+', halt = True)
+                table[state] = INVALIDPUSH * 2 + 1
+            elif moves[state] == 1:
+                table[state] = targets[state] * 2
+            elif moves[state] == -1 and prev_transition_table[targets[state]] & 1:
+                table[state] = prev_transition_table[targets[state]]
+            elif moves[state] == -1:
+                carry_on[state] = prev_transition_table[targets[state]] >> 1
+            else:
+                carry_on[state] = targets[state]
+        for state in range(len(self.state_names)):
+            chain = []
+            while table[state] is None:
+                chain.append(state)
+                table[state] = NO_TRANSITION # marks the states of the chain we're currently following
+                state = carry_on[state]
+            result = DOESNOTHALT * 2 + 1 if table[state] == NO_TRANSITION else table[state]
+            for chain_state in chain:
+                table[chain_state] = result
+        return tuple(table)
     @property
     def first_transition_table(self):
-        return {state: TableTransition(state, '+REJECT:INVALIDMOVE+', halt = True) for state in self.states}
+        return (INVALIDMOVE * 2 + 1,) * len(self.state_names)
+    def push_transition_table(self, table_id, new_value):
+        # id of the table for the stack with table table_id after pushing new_value
+        new_table_id = self.composition_cache.get(table_id, new_value)
+        if new_table_id is None:
+            new_transition_table = self.make_transition_table(self.transition_tables[table_id], new_value)
+            if new_transition_table not in self.table_ids:
+                self.table_ids[new_transition_table] = len(self.transition_tables)
+                self.transition_tables.append(new_transition_table)
+            new_table_id = self.table_ids[new_transition_table]
+            self.composition_cache.put(table_id, new_value, new_table_id)
+        return new_table_id
     def run_with_transition_tables(self, state, verbose = False):
         # guaranteed to halt!! (in exponential time, tbf)
         # see: Nonerasing Stack Automata, J. Hopcroft, J. Ullman, Journal of Computer and Systems Sciences, 1 (1967), pp. 166-186
@@ -115,43 +368,35 @@ class NonErasingStackAutomaton:
         # estimate worst case runtime:
         print(f"may have to run through {pow(len(self.states), 2) * 2} tables in the worst case")
 
-        current_transition_table = self.first_transition_table
-        all_transition_tables = [(current_transition_table, [])] # have to use an assoc-list because dicts aren't valid dict keys
+        state = self.state_ids[state]
+        width = len(self.symbol_names)
+        # (table, state) pairs we've been in are kept as table_id * n + state
+        table_id = 0
+        visited = set()
         while True:
-            if (state, 'BLANK') in self.transitions:
-                t = self.transitions[(state, 'BLANK')]
+            i = state * width # reading BLANK, which is symbol 0
+            if self.targets[i] != NO_TRANSITION:
                 if verbose:
-                    print(f"{t.state_from} -> {t.state_to}")
+                    print(f"{self.state_names[state]} -> {self.state_names[self.targets[i]]}")
             else:
                 # if there's no transition for this situation, halt and return the current state
-                return state
-            state = t.state_to
-            if t.push is not None:
-                current_transition_table = self.make_transition_table(current_transition_table, t.push)
-                table_index = assoc_index(current_transition_table, all_transition_tables)
-                if table_index == -1:
-                    all_transition_tables.append((current_transition_table, []))
-            if t.move == 1:
-                return '+REJECT:INVALIDMOVE+'
-            if t.move == -1:
-                if current_transition_table[state].halt:
-                   return current_transition_table[state].state_to
+                return self.state_names[state]
+            state = self.targets[i]
+            if self.pushes[i] != NO_TRANSITION:
+                table_id = self.push_transition_table(table_id, self.pushes[i])
+            if self.moves[i] == 1:
+                return self.state_names[INVALIDMOVE]
+            if self.moves[i] == -1:
+                if self.transition_tables[table_id][state] & 1:
+                   return self.state_names[self.transition_tables[table_id][state] >> 1]
                 else:
-                    state = current_transition_table[state].state_to
-                
-            table_index = assoc_index(current_transition_table, all_transition_tables)
-            if state in all_transition_tables[table_index][1]:
+                    state = self.transition_tables[table_id][state] >> 1
+
+            if table_id * len(self.state_names) + state in visited:
                 # non-halting program detected
-                return '+DOESNOTHALT+'
+                return self.state_names[DOESNOTHALT]
             else:
-                all_transition_tables[table_index] = (all_transition_tables[table_index][0], all_transition_tables[table_index][1] + [state])
-            
-
-def assoc_index(v, al):
-    for i in range(len(al)):
-        if al[i][0] == v:
-            return i
-    return -1
+                visited.add(table_id * len(self.state_names) + state)
 
 # tests
 #test = NonErasingStackAutomaton([Transition('a', 'BLANK', 'b', {'push': 'X'}), Transition('b', 'X', 'a', {'move': 'left'})])
@@ -1,12 +1,14 @@
 from nedsascript import construct_nedsa
+import os
 import sys
 
 if __name__ == "__main__":
     with open(sys.argv[2]) as file:
-      nedsa = construct_nedsa(file.read())
+      # compiled programs are cached, so running an unchanged program again doesn't have to compile it
+      nedsa = construct_nedsa(file.read(), cache_dir = os.environ.get('NEDSASCRIPT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'nedsascript')))
       #nedsa.nedsa.print_transitions()
     if sys.argv[1] == 'run':
-      print(nedsa.run())
+      print(nedsa.run(verbose = True))
     elif sys.argv[1] == 'decide':
       print(nedsa.decide(verbose = True))
     else:
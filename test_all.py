@@ -1,6 +1,7 @@
 import pytest
 import sys
 from nedsascript import construct_nedsa
+from nedsascript.stackautomaton import NonErasingStackAutomaton, Transition, ANY
 
 
 def test_loop():
@@ -15,6 +16,8 @@ def test_if():
     assertfile('testif.nedsa', 'SUCCESS')
 def test_rps():
     assertfile('testrps.nedsa', '+DOESNOTHALT+')
+def test_descentloop():
+    assertfile('testdescentloop.nedsa', '+DOESNOTHALT+')
 
 def assertfile(filename, result):
     with open('tests/' + filename, 'r') as src:
@@ -24,3 +27,80 @@ def test_runvsdecide():
     with open('tests/teststartendlabel.nedsa', 'r') as src: # using teststartendlabel just as a script that halts
         script = construct_nedsa(src.read())
         assert script.decide() == script.run()
+
+def test_handbuilt():
+    # the same automata as the examples at the bottom of stackautomaton.py, built without going through the compiler
+    test = NonErasingStackAutomaton([Transition('+START+', 'BLANK', 'b', {'push': 'X'}), Transition('b', 'X', '+START+', {'move': 'left'})])
+    assert test.run_with_transition_tables('+START+') == 'b' == test.run('+START+')
+    xyzforever = NonErasingStackAutomaton([Transition('+START+', 'BLANK', 'b', {'push': 'X'}), Transition('b', 'BLANK', 'c', {'push': 'Y'}), Transition('c', 'BLANK', '+START+', {'push': 'Z'})])
+    assert xyzforever.run_with_transition_tables('+START+') == '+DOESNOTHALT+'
+    assert xyzforever.symbol_names[0] == 'BLANK' and len(xyzforever.targets) == len(xyzforever.state_names) * 4
+
+def test_compositioncache():
+    with open('tests/testgrow.nedsa', 'r') as src:
+        script = construct_nedsa(src.read())
+    assert script.decide() == '+DOESNOTHALT+'
+    misses = script.minimized.composition_cache.misses
+    assert script.decide() == '+DOESNOTHALT+'
+    assert script.minimized.composition_cache.misses == misses and script.minimized.composition_cache.hits > 0
+
+def test_lazyconstruction():
+    # building forwards from the initial variable values should give exactly the pruned automaton of the full expansion
+    for filename in ['testmove.nedsa', 'testrps.nedsa', 'testif.nedsa']:
+        with open('tests/' + filename, 'r') as src:
+            code = src.read()
+        lazy, full = construct_nedsa(code).nedsa, construct_nedsa(code, lazy = False).nedsa
+        assert lazy.state_names == full.state_names and lazy.targets == full.targets and lazy.pushes == full.pushes and lazy.moves == full.moves
+
+def test_defaulttransitions():
+    # reads X on the way back down, which has its own transition, so the default one is only taken on BLANK
+    nedsa = NonErasingStackAutomaton([Transition('+START+', ANY, 'a', {'push': 'X'}), Transition('a', ANY, 'b', {'move': 'left'}),
+                                      Transition('b', ANY, 'fail', {}), Transition('b', 'X', 'success', {})])
+    assert nedsa.run('+START+') == 'success' == nedsa.run_with_transition_tables('+START+')
+    with open('tests/testrps.nedsa', 'r') as src:
+        script = construct_nedsa(src.read())
+    assert len(script.nedsa.transitions) < len(script.nedsa.states) * len(script.nedsa.alphabet) / 2
+
+def test_minimize():
+    for filename, result in [('testmove.nedsa', 'SUCCESS'), ('testrps.nedsa', '+DOESNOTHALT+'), ('testif.nedsa', 'SUCCESS'), ('testloop.nedsa', '+DOESNOTHALT+')]:
+        with open('tests/' + filename, 'r') as src:
+            script = construct_nedsa(src.read())
+        assert script.decide() == script.decide(minimize = False) == result
+        assert script.state_counts[1] < script.state_counts[0]
+
+def test_fastrun():
+    for filename in ['testmove.nedsa', 'testif.nedsa', 'teststartendlabel.nedsa']:
+        with open('tests/' + filename, 'r') as src:
+            script = construct_nedsa(src.read())
+        assert script.run() == script.run(fast = False) == 'SUCCESS'
+    with open('tests/testgrow.nedsa', 'r') as src:
+        script = construct_nedsa(src.read())
+    assert script.run(max_steps = 1000) == script.run(fast = False, max_steps = 1000) == '+BUDGETEXCEEDED+'
+
+def test_cache(tmp_path):
+    with open('tests/testrps.nedsa', 'r') as src:
+        code = src.read()
+    compiled = construct_nedsa(code, cache_dir = tmp_path)
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = construct_nedsa(code, cache_dir = tmp_path)
+    assert cached.nedsa.state_names == compiled.nedsa.state_names and list(cached.nedsa.targets) == list(compiled.nedsa.targets)
+    assert cached.decide() == cached.decide(minimize = False) == '+DOESNOTHALT+'
+    next(tmp_path.iterdir()).write_bytes(b'not an automaton')
+    assert construct_nedsa(code, cache_dir = tmp_path).decide() == '+DOESNOTHALT+'
+
+def test_importpath(tmp_path, monkeypatch):
+    # the grammar is found through the package, not the working directory
+    with open('tests/testif.nedsa', 'r') as src:
+        code = src.read()
+    monkeypatch.chdir(tmp_path)
+    assert construct_nedsa(code).decide() == 'SUCCESS'
+
+def test_precedence():
+    # left associative, with * / % before + -
+    for expression, value in [('x - 1 - 1', 3), ('1 + 2 * 3', 7), ('x - 2 + 1', 4), ('x * 3 / 2 % 4', 3), ('(1 + 2) * 3', 9), ('x - (2 - 1)', 4)]:
+        code = f"VAR x = 5/20\nx = {expression}\nIF x = {value} {{\n  HALT RIGHT\n}}\nHALT WRONG\n"
+        assert construct_nedsa(code).decide() == construct_nedsa(code, lazy = False).decide() == 'RIGHT', expression
+
+def test_division():
+    # "/" in an expression, as well as in a variable declaration
+    assert construct_nedsa('VAR x = 0/9\nx = 9 / 2\nIF x = 4 {\n  HALT SUCCESS\n}\nHALT FAILURE\n').decide() == 'SUCCESS'